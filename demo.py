@@ -11,12 +11,17 @@ from unittest.mock import Mock, patch
 
 from models import Email, RuleExecution, create_tables
 from rule_engine import RuleEngine
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, select
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
 
 def create_demo_database():
     """Create in-memory database for demo"""
-    engine = create_engine('sqlite:///:memory:')
+    engine = create_engine(
+        'sqlite:///:memory:',
+        poolclass=StaticPool,
+        connect_args={'check_same_thread': False}
+    )
     # Create tables directly instead of using create_tables() which uses config
     from models import Base
     Base.metadata.create_all(engine)
@@ -198,7 +203,9 @@ def print_email_status(session, title):
     print(f"\n{title}")
     print("=" * 50)
     
-    emails = session.query(Email).all()
+    emails = session.execute(
+        select(Email.id, Email.from_address, Email.subject, Email.is_read, Email.labels)
+    ).yield_per(200)
     for email in emails:
         read_status = "READ" if email.is_read else "UNREAD"
         labels = email.labels if email.labels else "No labels"
@@ -214,7 +221,15 @@ def print_rule_executions(session):
     print("\nRule Execution History")
     print("=" * 50)
     
-    executions = session.query(RuleExecution).all()
+    executions = session.execute(
+        select(
+            RuleExecution.rule_name,
+            RuleExecution.email_id,
+            RuleExecution.success,
+            RuleExecution.actions_taken,
+            RuleExecution.executed_at
+        )
+    ).yield_per(200)
     for execution in executions:
         success_status = "SUCCESS" if execution.success else "FAILED"
         print(f"Rule: {execution.rule_name}")
@@ -251,9 +266,8 @@ def main():
     try:
         # Process rules
         print("\nProcessing emails against rules...")
-        with patch('rule_engine.config.RULES_FILE', temp_file), \
-             patch('rule_engine.get_session', return_value=session):
-            engine = RuleEngine()
+        with patch('rule_engine.config.RULES_FILE', temp_file):
+            engine = RuleEngine(session=session)
             
             stats = engine.process_emails()
             
@@ -4,8 +4,14 @@ Handles fetching emails from Gmail API and storing them in the database
 """
 import base64
 import email
-from datetime import datetime
+import email.utils
+from collections import defaultdict
+from datetime import datetime, timezone
+from functools import lru_cache
 from typing import List, Dict, Optional
+from sqlalchemy import select, insert, update, bindparam
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import Session
 from sqlalchemy.exc import IntegrityError
 
@@ -13,6 +19,41 @@ from gmail_auth import get_gmail_service
 from models import Email, get_session
 from config import config
 
+# Sub-requests per batch HTTP request; Gmail accepts up to 100, but larger
+# batches than 50 are likely to trip its per-user rate limits
+GMAIL_BATCH_LIMIT = 50
+
+# Retries, with exponential backoff, for single requests that fail or are rate limited
+GMAIL_NUM_RETRIES = 3
+
+# Dialect-specific INSERT constructs supporting ON CONFLICT upserts
+UPSERT_INSERTS = {
+    'postgresql': postgresql_insert,
+    'sqlite': sqlite_insert
+}
+
+# Column names accepted from fetched email dictionaries
+EMAIL_COLUMNS = frozenset(Email.__table__.c.keys())
+
+# Headers requested when the message body is not needed
+METADATA_HEADERS = ['From', 'To', 'Subject', 'Date']
+
+@lru_cache(maxsize=4096)
+def _parse_rfc2822_date(date_str: str) -> datetime:
+    """
+    Parse an RFC 2822 date header into a naive UTC datetime
+    Results are cached since the same header values recur across a mailbox.
+    Raises ValueError or TypeError if the date cannot be parsed.
+    """
+    parsed_date = email.utils.parsedate_to_datetime(date_str)
+    if parsed_date.tzinfo is not None:
+        parsed_date = parsed_date.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed_date
+
+def _decode_body_data(data: str) -> str:
+    """Decode base64url encoded body data from the Gmail API"""
+    return base64.urlsafe_b64decode(data).decode('utf-8', errors='ignore')
+
 class EmailFetcher:
     """Class to handle email fetching and storage operations"""
     
@@ -20,11 +61,12 @@ class EmailFetcher:
         self.service = get_gmail_service()
         self.session = get_session()
     
-    def fetch_emails(self, max_results: int = None) -> List[Dict]:
+    def fetch_emails(self, max_results: int = None, need_body: bool = True) -> List[Dict]:
         """
         Fetch emails from Gmail inbox
         Args:
             max_results: Maximum number of emails to fetch
+            need_body: Whether to download message bodies
         Returns:
             List of email dictionaries
         """
@@ -39,13 +81,14 @@ class EmailFetcher:
                 labelIds=['INBOX']
             ).execute()
             
-            messages = results.get('messages', [])
+            message_ids = [message['id'] for message in results.get('messages', [])]
             emails = []
             
-            for message in messages:
-                email_data = self._fetch_email_details(message['id'])
-                if email_data:
-                    emails.append(email_data)
+            for start in range(0, len(message_ids), GMAIL_BATCH_LIMIT):
+                emails.extend(self._fetch_email_details_batch(
+                    message_ids[start:start + GMAIL_BATCH_LIMIT],
+                    need_body
+                ))
             
             return emails
             
@@ -53,21 +96,98 @@ class EmailFetcher:
             print(f"Error fetching emails: {e}")
             return []
     
-    def _fetch_email_details(self, message_id: str) -> Optional[Dict]:
+    def _message_request(self, message_id: str, need_body: bool):
+        """
+        Build the messages.get request for an email
+        Args:
+            message_id: Gmail message ID
+            need_body: Whether to request the full MIME payload
+        Returns:
+            Gmail API request object
+        """
+        if need_body:
+            return self.service.users().messages().get(
+                userId='me',
+                id=message_id,
+                format='full'
+            )
+        
+        return self.service.users().messages().get(
+            userId='me',
+            id=message_id,
+            format='metadata',
+            metadataHeaders=METADATA_HEADERS
+        )
+    
+    def _fetch_email_details(self, message_id: str, need_body: bool = True) -> Optional[Dict]:
         """
         Fetch detailed information for a specific email
         Args:
             message_id: Gmail message ID
+            need_body: Whether to download the message body
         Returns:
             Dictionary with email details or None if error
         """
         try:
-            message = self.service.users().messages().get(
-                userId='me', 
-                id=message_id,
-                format='full'
-            ).execute()
+            message = self._message_request(message_id, need_body).execute(
+                num_retries=GMAIL_NUM_RETRIES
+            )
+            
+            return self._parse_message(message, need_body)
             
+        except Exception as e:
+            print(f"Error fetching email details for {message_id}: {e}")
+            return None
+    
+    def _fetch_email_details_batch(self, message_ids: List[str], need_body: bool = True) -> List[Dict]:
+        """
+        Fetch detailed information for several emails in one batch HTTP request
+        Emails whose sub-request failed, or the whole batch if it could not be
+        sent, are fetched again one at a time with retries.
+        Args:
+            message_ids: Gmail message IDs (at most GMAIL_BATCH_LIMIT)
+            need_body: Whether to download message bodies
+        Returns:
+            List of email dictionaries in the order of message_ids
+        """
+        messages = {}
+        
+        def on_response(request_id, response, exception):
+            if exception is not None:
+                print(f"Error fetching email details for {request_id}: {exception}")
+            else:
+                messages[request_id] = response
+        
+        batch = self.service.new_batch_http_request(callback=on_response)
+        for message_id in message_ids:
+            batch.add(self._message_request(message_id, need_body), request_id=message_id)
+        try:
+            batch.execute()
+        except Exception as e:
+            print(f"Error executing batch request: {e}")
+        
+        emails = []
+        for message_id in message_ids:
+            if message_id in messages:
+                email_data = self._parse_message(messages[message_id], need_body)
+            else:
+                email_data = self._fetch_email_details(message_id, need_body)
+            if email_data:
+                emails.append(email_data)
+        
+        return emails
+    
+    def _parse_message(self, message: Dict, need_body: bool = True) -> Optional[Dict]:
+        """
+        Convert a Gmail API message resource into an email dictionary
+        Without the body, 'message_body' is left out so stored bodies are kept
+        Args:
+            message: Message resource returned by the Gmail API
+            need_body: Whether the message resource includes the body
+        Returns:
+            Dictionary with email details or None if error
+        """
+        try:
             headers = message['payload'].get('headers', [])
             header_dict = {h['name']: h['value'] for h in headers}
             
@@ -81,14 +201,16 @@ class EmailFetcher:
                 'received_date': self._parse_date(header_dict.get('Date', '')),
                 'is_read': 'UNREAD' not in message.get('labelIds', []),
                 'labels': ','.join(message.get('labelIds', [])),
-                'snippet': message.get('snippet', ''),
-                'message_body': self._extract_message_body(message['payload'])
+                'snippet': message.get('snippet', '')
             }
             
+            if need_body:
+                email_data['message_body'] = self._extract_message_body(message['payload'])
+            
             return email_data
             
         except Exception as e:
-            print(f"Error fetching email details for {message_id}: {e}")
+            print(f"Error parsing email details for {message.get('id', 'unknown')}: {e}")
             return None
     
     def _parse_date(self, date_str: str) -> datetime:
@@ -97,12 +219,11 @@ class EmailFetcher:
         Args:
             date_str: Date string from email header
         Returns:
-            datetime object
+            Naive UTC datetime object
         """
         try:
             # Parse RFC 2822 date format
-            parsed_date = email.utils.parsedate_to_datetime(date_str)
-            return parsed_date
+            return _parse_rfc2822_date(date_str)
         except Exception:
             # Fallback to current time if parsing fails
             return datetime.utcnow()
@@ -110,88 +231,139 @@ class EmailFetcher:
     def _extract_message_body(self, payload: Dict) -> str:
         """
         Extract message body from email payload
+        Plain text parts are preferred; HTML is only decoded when the
+        message has no plain text alternative.
         Args:
             payload: Email payload from Gmail API
         Returns:
             Message body as string
         """
-        body = ""
+        text_parts = {'text/plain': [], 'text/html': []}
+        self._collect_text_parts(payload, text_parts)
         
+        if text_parts['text/plain']:
+            return ''.join(_decode_body_data(data) for data in text_parts['text/plain'])
+        if text_parts['text/html']:
+            return _decode_body_data(text_parts['text/html'][0])
+        return ""
+    
+    def _collect_text_parts(self, payload: Dict, text_parts: Dict[str, List[str]]):
+        """
+        Collect encoded text part data from a payload, including nested multiparts
+        Args:
+            payload: Email payload (or part) from Gmail API
+            text_parts: Encoded data lists keyed by MIME type, filled in place
+        """
         if 'parts' in payload:
-            # Multipart message
             for part in payload['parts']:
-                if part['mimeType'] == 'text/plain':
-                    data = part['body'].get('data', '')
-                    if data:
-                        body += base64.urlsafe_b64decode(data).decode('utf-8', errors='ignore')
-                elif part['mimeType'] == 'text/html' and not body:
-                    # Use HTML if no plain text found
-                    data = part['body'].get('data', '')
-                    if data:
-                        body = base64.urlsafe_b64decode(data).decode('utf-8', errors='ignore')
-        else:
-            # Single part message
-            if payload['mimeType'] in ['text/plain', 'text/html']:
-                data = payload['body'].get('data', '')
-                if data:
-                    body = base64.urlsafe_b64decode(data).decode('utf-8', errors='ignore')
-        
-        return body
+                self._collect_text_parts(part, text_parts)
+        elif payload.get('mimeType') in text_parts:
+            data = payload.get('body', {}).get('data', '')
+            if data:
+                text_parts[payload['mimeType']].append(data)
     
     def store_emails(self, emails: List[Dict]) -> int:
         """
         Store emails in the database
+        On PostgreSQL and SQLite the batch is written as a single upsert that
+        relies on the primary key; other backends bulk insert new emails and
+        bulk update existing ones.
         Args:
             emails: List of email dictionaries
         Returns:
             Number of emails successfully stored
         """
-        stored_count = 0
-        
-        for email_data in emails:
-            try:
-                # Check if email already exists
-                existing_email = self.session.query(Email).filter_by(id=email_data['id']).first()
-                
-                if existing_email:
-                    # Update existing email
-                    for key, value in email_data.items():
-                        if hasattr(existing_email, key):
-                            setattr(existing_email, key, value)
-                    existing_email.updated_at = datetime.utcnow()
-                else:
-                    # Create new email record
-                    email_obj = Email(**email_data)
-                    self.session.add(email_obj)
-                
-                stored_count += 1
-                
-            except IntegrityError as e:
-                print(f"Integrity error storing email {email_data.get('id', 'unknown')}: {e}")
-                self.session.rollback()
-            except Exception as e:
-                print(f"Error storing email {email_data.get('id', 'unknown')}: {e}")
-                self.session.rollback()
+        if not emails:
+            return 0
         
         try:
+            # Keep only known columns; a repeated ID keeps its latest data
+            rows = {}
+            for email_data in emails:
+                rows[email_data['id']] = {
+                    key: value for key, value in email_data.items() if key in EMAIL_COLUMNS
+                }
+            
+            # Bulk statements take their columns from the first row, so rows
+            # with different keys are written in separate groups
+            groups = defaultdict(dict)
+            for email_id, row in rows.items():
+                groups[frozenset(row)][email_id] = row
+            
+            dialect_insert = UPSERT_INSERTS.get(self.session.get_bind().dialect.name)
+            for group in groups.values():
+                if dialect_insert is not None:
+                    self._upsert_rows(list(group.values()), dialect_insert)
+                else:
+                    self._insert_or_update_rows(group)
+            
             self.session.commit()
+            return len(rows)
+            
+        except IntegrityError as e:
+            print(f"Integrity error storing emails: {e}")
+            self.session.rollback()
         except Exception as e:
-            print(f"Error committing email storage: {e}")
+            print(f"Error storing emails: {e}")
             self.session.rollback()
-            stored_count = 0
         
-        return stored_count
+        return 0
+    
+    def _upsert_rows(self, rows: List[Dict], dialect_insert):
+        """
+        Insert or update email rows with INSERT ... ON CONFLICT
+        The psycopg2 dialect sends the parameter list as multi-row VALUES pages.
+        Args:
+            rows: Email column dictionaries sharing the same keys
+            dialect_insert: Dialect insert() construct supporting on_conflict_do_update
+        """
+        stmt = dialect_insert(Email.__table__)
+        update_values = {key: stmt.excluded[key] for key in rows[0] if key != 'id'}
+        update_values['updated_at'] = datetime.utcnow()
+        stmt = stmt.on_conflict_do_update(index_elements=['id'], set_=update_values)
+        self.session.execute(stmt, rows)
+    
+    def _insert_or_update_rows(self, rows: Dict[str, Dict]):
+        """
+        Bulk insert new email rows and bulk update existing ones
+        Args:
+            rows: Email column dictionaries sharing the same keys, keyed by email ID
+        """
+        table = Email.__table__
+        
+        # Partition into new and existing emails with a single query
+        existing_ids = set(self.session.scalars(
+            select(table.c.id).where(table.c.id.in_(list(rows)))
+        ))
+        new_rows = [row for email_id, row in rows.items() if email_id not in existing_ids]
+        update_rows = [row for email_id, row in rows.items() if email_id in existing_ids]
+        
+        if new_rows:
+            self.session.execute(insert(table), new_rows)
+        
+        if update_rows:
+            update_columns = [key for key in update_rows[0] if key != 'id']
+            stmt = (
+                update(table)
+                .where(table.c.id == bindparam('b_id'))
+                .values({key: bindparam(key) for key in update_columns})
+            )
+            self.session.execute(stmt, [
+                {'b_id': row['id'], **{key: row.get(key) for key in update_columns}}
+                for row in update_rows
+            ])
     
-    def fetch_and_store_emails(self, max_results: int = None) -> int:
+    def fetch_and_store_emails(self, max_results: int = None, need_body: bool = True) -> int:
         """
         Fetch emails from Gmail and store them in database
         Args:
             max_results: Maximum number of emails to fetch
+            need_body: Whether to download message bodies
         Returns:
             Number of emails successfully stored
         """
         print("Fetching emails from Gmail...")
-        emails = self.fetch_emails(max_results)
+        emails = self.fetch_emails(max_results, need_body)
         print(f"Fetched {len(emails)} emails")
         
         if emails:
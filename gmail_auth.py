@@ -3,27 +3,38 @@ Gmail API Authentication Module
 Handles OAuth authentication with Google's Gmail API
 """
 import os
-import pickle
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
+from functools import lru_cache
 from config import config
 
+# Google client libraries are imported inside the functions below so that
+# commands which never talk to Gmail do not pay for loading them
+
+@lru_cache(maxsize=1)
 def authenticate_gmail():
     """
     Authenticate with Gmail API using OAuth2
+    The credentials are cached for the lifetime of the process
     Returns authenticated service object
     """
+    from google.oauth2.credentials import Credentials
+    
     creds = None
     
     # Check if token file exists
     if os.path.exists(config.GMAIL_TOKEN_FILE):
-        with open(config.GMAIL_TOKEN_FILE, 'rb') as token:
-            creds = pickle.load(token)
+        try:
+            creds = Credentials.from_authorized_user_file(
+                config.GMAIL_TOKEN_FILE,
+                config.GMAIL_SCOPES
+            )
+        except ValueError:
+            # Unreadable or legacy pickled token; fall through to re-authenticate
+            creds = None
     
     # If there are no (valid) credentials available, let the user log in
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
+            from google.auth.transport.requests import Request
             creds.refresh(Request())
         else:
             if not os.path.exists(config.GMAIL_CREDENTIALS_FILE):
@@ -32,6 +43,7 @@ def authenticate_gmail():
                     "Please download it from Google Cloud Console."
                 )
             
+            from google_auth_oauthlib.flow import InstalledAppFlow
             flow = InstalledAppFlow.from_client_secrets_file(
                 config.GMAIL_CREDENTIALS_FILE, 
                 config.GMAIL_SCOPES
@@ -39,17 +51,20 @@ def authenticate_gmail():
             creds = flow.run_local_server(port=0)
         
         # Save the credentials for the next run
-        with open(config.GMAIL_TOKEN_FILE, 'wb') as token:
-            pickle.dump(creds, token)
+        with open(config.GMAIL_TOKEN_FILE, 'w') as token:
+            token.write(creds.to_json())
     
     return creds
 
+@lru_cache(maxsize=1)
 def get_gmail_service():
     """
     Get authenticated Gmail service object
+    The service is built once per process and shared by all callers
     """
     from googleapiclient.discovery import build
     
     creds = authenticate_gmail()
-    service = build('gmail', 'v1', credentials=creds)
+    # The discovery document ships with googleapiclient; skip the file cache lookup
+    service = build('gmail', 'v1', credentials=creds, cache_discovery=False)
     return service
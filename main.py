@@ -4,26 +4,39 @@ Main script for Gmail Rule Operations
 This script fetches emails from Gmail and processes them based on configured rules
 """
 import sys
+import queue
 import argparse
 import logging
+from logging.handlers import QueueHandler, QueueListener
 from datetime import datetime
 
-from email_fetcher import EmailFetcher
-from rule_engine import RuleEngine
+from rule_engine import RuleEngine, load_rules, rules_need_message_body
 from models import create_tables
 from config import config
 
-# Set up logging
-logging.basicConfig(
-    level=getattr(logging, config.LOG_LEVEL),
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
+logger = logging.getLogger(__name__)
+
+def setup_logging() -> QueueListener:
+    """
+    Route logging through a queue to the log file and stdout
+    Records are formatted by the QueueHandler and written by a background
+    listener thread, off the caller's path.
+    Returns:
+        The started listener; stop it to flush queued records
+    """
+    log_queue = queue.SimpleQueue()
+    log_listener = QueueListener(
+        log_queue,
         logging.FileHandler(config.LOG_FILE),
         logging.StreamHandler(sys.stdout)
-    ]
-)
-
-logger = logging.getLogger(__name__)
+    )
+    logging.basicConfig(
+        level=getattr(logging, config.LOG_LEVEL),
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        handlers=[QueueHandler(log_queue)]
+    )
+    log_listener.start()
+    return log_listener
 
 def setup_database():
     """Initialize database tables"""
@@ -42,9 +55,15 @@ def fetch_emails(max_emails: int = None):
     """
     logger.info("Starting email fetch process...")
     
+    # Imported here so commands that skip fetching avoid loading the Gmail client
+    from email_fetcher import EmailFetcher
+    
+    # Message bodies are only downloaded when a rule inspects them
+    need_body = rules_need_message_body(load_rules())
+    
     fetcher = EmailFetcher()
     try:
-        stored_count = fetcher.fetch_and_store_emails(max_emails)
+        stored_count = fetcher.fetch_and_store_emails(max_emails, need_body)
         logger.info(f"Email fetch completed. Stored {stored_count} emails.")
     except Exception as e:
         logger.error(f"Error during email fetch: {e}")
@@ -69,44 +88,49 @@ def process_rules():
 
 def main():
     """Main function"""
-    parser = argparse.ArgumentParser(description='Gmail Rule Operations')
-    parser.add_argument('--setup-db', action='store_true', 
-                       help='Initialize database tables')
-    parser.add_argument('--fetch-emails', action='store_true',
-                       help='Fetch emails from Gmail')
-    parser.add_argument('--process-rules', action='store_true',
-                       help='Process emails against rules')
-    parser.add_argument('--max-emails', type=int, default=None,
-                       help='Maximum number of emails to fetch')
-    parser.add_argument('--all', action='store_true',
-                       help='Run all operations (setup, fetch, process)')
-    
-    args = parser.parse_args()
-    
-    if not any([args.setup_db, args.fetch_emails, args.process_rules, args.all]):
-        parser.print_help()
-        return
-    
-    logger.info("Gmail Rule Operations started")
-    logger.info(f"Configuration: {config.RULES_FILE}, {config.DATABASE_URL}")
-    
+    log_listener = setup_logging()
     try:
-        if args.setup_db or args.all:
-            setup_database()
-        
-        if args.fetch_emails or args.all:
-            fetch_emails(args.max_emails)
-        
-        if args.process_rules or args.all:
-            process_rules()
-            
-    except KeyboardInterrupt:
-        logger.info("Operation cancelled by user")
-    except Exception as e:
-        logger.error(f"Unexpected error: {e}")
-        sys.exit(1)
-    
-    logger.info("Gmail Rule Operations completed")
+        parser = argparse.ArgumentParser(description='Gmail Rule Operations')
+        parser.add_argument('--setup-db', action='store_true', 
+                           help='Initialize database tables')
+        parser.add_argument('--fetch-emails', action='store_true',
+                           help='Fetch emails from Gmail')
+        parser.add_argument('--process-rules', action='store_true',
+                           help='Process emails against rules')
+        parser.add_argument('--max-emails', type=int, default=None,
+                           help='Maximum number of emails to fetch')
+        parser.add_argument('--all', action='store_true',
+                           help='Run all operations (setup, fetch, process)')
+
+        args = parser.parse_args()
+
+        if not any([args.setup_db, args.fetch_emails, args.process_rules, args.all]):
+            parser.print_help()
+            return
+
+        logger.info("Gmail Rule Operations started")
+        logger.info(f"Configuration: {config.RULES_FILE}, {config.DATABASE_URL}")
+
+        try:
+            if args.setup_db or args.all:
+                setup_database()
+
+            if args.fetch_emails or args.all:
+                fetch_emails(args.max_emails)
+
+            if args.process_rules or args.all:
+                process_rules()
+
+        except KeyboardInterrupt:
+            logger.info("Operation cancelled by user")
+        except Exception as e:
+            logger.error(f"Unexpected error: {e}")
+            sys.exit(1)
+
+        logger.info("Gmail Rule Operations completed")
+    finally:
+        # Flush queued log records before exiting
+        log_listener.stop()
 
 if __name__ == "__main__":
     main()
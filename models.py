@@ -1,17 +1,32 @@
 """
 Database models for Gmail Rule Operations
 """
-from sqlalchemy import create_engine, Column, String, DateTime, Text, Boolean, Integer
+from sqlalchemy import create_engine, event, func, Column, String, DateTime, Text, Boolean, Integer, Index
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.engine import make_url
+from sqlalchemy.schema import CreateIndex
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from contextlib import contextmanager
 from datetime import datetime
+from functools import lru_cache
+from typing import Optional
 from config import config
 
 Base = declarative_base()
 
+@lru_cache(maxsize=1024)
+def _parse_labels(labels: str) -> frozenset:
+    """Split a comma-separated labels string; label combinations repeat heavily"""
+    return frozenset(labels.split(',')) if labels else frozenset()
+
 class Email(Base):
     """Email model to store Gmail messages"""
     __tablename__ = 'emails'
+    __table_args__ = (
+        # Also serves lookups on from_address alone
+        Index('ix_email_from_received', 'from_address', 'received_date'),
+    )
     
     id = Column(String, primary_key=True)  # Gmail message ID
     thread_id = Column(String, nullable=False)
@@ -19,12 +34,44 @@ class Email(Base):
     to_address = Column(String, nullable=True)
     subject = Column(String, nullable=True)
     message_body = Column(Text, nullable=True)
-    received_date = Column(DateTime, nullable=False)
+    received_date = Column(DateTime, nullable=False, index=True)
     is_read = Column(Boolean, default=False)
     labels = Column(String, nullable=True)  # Comma-separated list of labels
     snippet = Column(Text, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def has_label(self, label: str) -> bool:
+        """Check whether the email carries a label"""
+        return label in _parse_labels(self.labels)
+    
+    def lowered(self, attribute: str) -> str:
+        """
+        Lower-cased value of a text column, computed once per column value
+        Args:
+            attribute: Column attribute name, e.g. 'subject'
+        Returns:
+            Lower-cased value, '' for NULL
+        """
+        value = getattr(self, attribute) or ''
+        cache = self.__dict__.setdefault('_lowered', {})
+        cached = cache.get(attribute)
+        # Compare by identity so assigning a new value invalidates the entry
+        if cached is None or cached[0] is not value:
+            cached = cache[attribute] = (value, value.lower())
+        return cached[1]
+    
+    def labels_with(self, label: str) -> Optional[str]:
+        """Return the labels column value with a label appended if missing"""
+        if self.has_label(label):
+            return self.labels
+        return f"{self.labels},{label}" if self.labels else label
+
+# Expression indexes for the case-insensitive equals conditions rule_engine
+# pushes into SQL; they must match its lower(column) expressions exactly
+Index('ix_email_from_lower', func.lower(Email.from_address))
+Index('ix_email_to_lower', func.lower(Email.to_address))
+Index('ix_email_subject_lower', func.lower(Email.subject))
 
 class RuleExecution(Base):
     """Model to track rule executions"""
@@ -32,23 +79,88 @@ class RuleExecution(Base):
     
     id = Column(Integer, primary_key=True, autoincrement=True)
     rule_name = Column(String, nullable=False)
-    email_id = Column(String, nullable=False)
+    email_id = Column(String, nullable=False, index=True)
     executed_at = Column(DateTime, default=datetime.utcnow)
     actions_taken = Column(Text, nullable=True)  # JSON string of actions performed
     success = Column(Boolean, default=True)
 
+# SQLite connection tuning: WAL journal with NORMAL sync avoids an fsync per
+# commit, and a larger page cache / in-memory temp store keeps scratch work off disk
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-64000",
+    "PRAGMA mmap_size=268435456",
+)
+
+def _apply_sqlite_pragmas(dbapi_connection, connection_record):
+    """Apply SQLITE_PRAGMAS to every new SQLite connection"""
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
 # Database setup
+@lru_cache(maxsize=None)
+def _build_engine(database_url: str):
+    """Create the engine for a database URL once and reuse its connection pool"""
+    url = make_url(database_url)
+    if url.get_backend_name() == 'sqlite':
+        if url.database in (None, '', ':memory:'):
+            # A single shared connection keeps the in-memory database alive
+            engine = create_engine(
+                url,
+                poolclass=StaticPool,
+                connect_args={'check_same_thread': False}
+            )
+        else:
+            engine = create_engine(url)
+        event.listen(engine, 'connect', _apply_sqlite_pragmas)
+        return engine
+    
+    return create_engine(url, pool_pre_ping=True, pool_size=5, max_overflow=10)
+
+@lru_cache(maxsize=None)
+def _build_sessionmaker(engine):
+    """Create the session factory bound to an engine"""
+    return sessionmaker(bind=engine)
+
 def get_database_engine():
-    """Create and return database engine"""
-    return create_engine(config.DATABASE_URL)
+    """Return the shared database engine for the configured URL"""
+    return _build_engine(config.DATABASE_URL)
 
 def get_session():
     """Create and return database session"""
-    engine = get_database_engine()
-    Session = sessionmaker(bind=engine)
+    Session = _build_sessionmaker(get_database_engine())
     return Session()
 
-def create_tables():
-    """Create all database tables"""
-    engine = get_database_engine()
+@contextmanager
+def no_expire_on_commit(session):
+    """
+    Keep loaded objects populated across commits made inside the block
+    Without this every commit expires all loaded objects and the next
+    attribute access reloads each one with its own SELECT.
+    """
+    previous = session.expire_on_commit
+    session.expire_on_commit = False
+    try:
+        yield session
+    finally:
+        session.expire_on_commit = previous
+
+def create_tables(engine=None):
+    """
+    Create all database tables
+    Args:
+        engine: Engine to create them on, defaults to get_database_engine()
+    """
+    engine = engine if engine is not None else get_database_engine()
     Base.metadata.create_all(engine)
+    
+    # create_all() skips existing tables, so add indexes missing from older
+    # databases; IF NOT EXISTS also covers expression indexes reflection misses
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                connection.execute(CreateIndex(index, if_not_exists=True))
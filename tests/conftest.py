@@ -0,0 +1,65 @@
+"""
+Shared fixtures for the test suite
+"""
+import pytest
+from datetime import datetime
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+
+from models import Base
+
+# Speed over durability for the in-memory test database
+TEST_SQLITE_PRAGMAS = (
+    "PRAGMA synchronous=OFF",
+    "PRAGMA journal_mode=MEMORY",
+    "PRAGMA locking_mode=EXCLUSIVE",
+    "PRAGMA temp_store=MEMORY",
+)
+
+@pytest.fixture(scope="session")
+def db_engine():
+    """Create the in-memory test database and its schema once per test run"""
+    engine = create_engine(
+        'sqlite:///:memory:',
+        poolclass=StaticPool,
+        connect_args={'check_same_thread': False}
+    )
+    
+    # pysqlite's own transaction handling breaks SAVEPOINTs; let SQLAlchemy
+    # emit BEGIN itself so nested transactions roll back correctly
+    @event.listens_for(engine, "connect")
+    def _configure_connection(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for pragma in TEST_SQLITE_PRAGMAS:
+            cursor.execute(pragma)
+        cursor.close()
+    
+    @event.listens_for(engine, "begin")
+    def _begin(connection):
+        connection.exec_driver_sql("BEGIN")
+    
+    Base.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+@pytest.fixture
+def temp_db(db_engine):
+    """
+    Session isolated inside a transaction that is rolled back after the test
+    Commits made by the code under test only release a SAVEPOINT, so every
+    test starts from the empty schema without re-running DDL.
+    """
+    connection = db_engine.connect()
+    transaction = connection.begin()
+    session = Session(bind=connection, join_transaction_mode="create_savepoint")
+    yield session
+    session.close()
+    transaction.rollback()
+    connection.close()
+
+@pytest.fixture
+def now():
+    """One UTC reference time for everything a test constructs"""
+    return datetime.utcnow()
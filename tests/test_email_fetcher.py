@@ -7,23 +7,13 @@ from datetime import datetime
 from unittest.mock import Mock, patch, MagicMock
 
 from email_fetcher import EmailFetcher
-from models import Email, Base
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from models import Email
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
 
 class TestEmailFetcher:
     """Test cases for EmailFetcher class"""
     
-    @pytest.fixture
-    def temp_db(self):
-        """Create temporary database for testing"""
-        engine = create_engine('sqlite:///:memory:')
-        Base.metadata.create_all(engine)
-        Session = sessionmaker(bind=engine)
-        session = Session()
-        yield session
-        session.close()
-    
     @pytest.fixture
     def mock_gmail_service(self):
         """Mock Gmail service"""
@@ -37,6 +27,14 @@ class TestEmailFetcher:
         result = fetcher._parse_date(date_str)
         assert isinstance(result, datetime)
     
+    @patch('email_fetcher.get_gmail_service')
+    def test_parse_date_normalized_to_utc(self, mock_get_service, temp_db):
+        """Test that parsed dates are converted to naive UTC"""
+        fetcher = EmailFetcher()
+        result = fetcher._parse_date("Mon, 1 Jan 2024 12:00:00 +0200")
+        assert result == datetime(2024, 1, 1, 10, 0, 0)
+        assert result.tzinfo is None
+    
     def test_parse_date_invalid(self, temp_db):
         """Test parsing invalid date string"""
         fetcher = EmailFetcher()
@@ -97,6 +95,41 @@ class TestEmailFetcher:
         result = fetcher._extract_message_body(payload)
         assert result == 'Plain text version'
     
+    @patch('email_fetcher.get_gmail_service')
+    def test_extract_message_body_nested_multipart(self, mock_get_service, temp_db):
+        """Test extracting plain text from a nested multipart email"""
+        fetcher = EmailFetcher()
+        
+        payload = {
+            'mimeType': 'multipart/mixed',
+            'parts': [
+                {
+                    'mimeType': 'multipart/alternative',
+                    'parts': [
+                        {
+                            'mimeType': 'text/html',
+                            'body': {
+                                'data': base64.urlsafe_b64encode(b'<p>HTML version</p>').decode('utf-8')
+                            }
+                        },
+                        {
+                            'mimeType': 'text/plain',
+                            'body': {
+                                'data': base64.urlsafe_b64encode(b'Plain text version').decode('utf-8')
+                            }
+                        }
+                    ]
+                },
+                {
+                    'mimeType': 'application/pdf',
+                    'body': {'attachmentId': 'attachment_1'}
+                }
+            ]
+        }
+        
+        result = fetcher._extract_message_body(payload)
+        assert result == 'Plain text version'
+    
     def test_extract_message_body_no_data(self, temp_db):
         """Test extracting message body when no data is available"""
         fetcher = EmailFetcher()
@@ -149,6 +182,37 @@ class TestEmailFetcher:
         assert result['is_read'] is False  # UNREAD label present
         assert result['message_body'] == 'Test message body'
     
+    @patch('email_fetcher.get_gmail_service')
+    def test_fetch_email_details_metadata_only(self, mock_get_service, temp_db):
+        """Test fetching email details without the message body"""
+        fetcher = EmailFetcher()
+        
+        mock_message = {
+            'id': 'test_message_id',
+            'threadId': 'test_thread_id',
+            'snippet': 'Test snippet',
+            'labelIds': ['INBOX'],
+            'payload': {
+                'headers': [
+                    {'name': 'From', 'value': 'test@example.com'},
+                    {'name': 'Subject', 'value': 'Test Subject'},
+                    {'name': 'Date', 'value': 'Mon, 1 Jan 2024 12:00:00 +0000'}
+                ],
+                'mimeType': 'text/plain'
+            }
+        }
+        
+        mock_service = Mock()
+        mock_service.users().messages().get.return_value.execute.return_value = mock_message
+        fetcher.service = mock_service
+        
+        result = fetcher._fetch_email_details('test_message_id', need_body=False)
+        
+        assert result['subject'] == 'Test Subject'
+        assert 'message_body' not in result  # Stored body is left untouched
+        _, kwargs = mock_service.users().messages().get.call_args
+        assert kwargs['format'] == 'metadata'
+        assert kwargs['metadataHeaders'] == ['From', 'To', 'Subject', 'Date']
     
     def test_store_emails_new_email(self, temp_db):
         """Test storing new emails"""
@@ -220,6 +284,94 @@ class TestEmailFetcher:
         assert updated_email.subject == 'New Subject'
         assert updated_email.is_read is True
     
+    @patch('email_fetcher.get_gmail_service')
+    def test_store_emails_mixed_batch(self, mock_get_service, temp_db):
+        """Test storing a batch with both new and existing emails"""
+        fetcher = EmailFetcher()
+        fetcher.session = temp_db
+
+        temp_db.add(Email(
+            id='existing_1',
+            thread_id='thread_1',
+            from_address='old@example.com',
+            received_date=datetime.utcnow(),
+            labels='INBOX'
+        ))
+        temp_db.commit()
+
+        emails = [
+            {
+                'id': email_id,
+                'thread_id': 'thread_1',
+                'from_address': 'new@example.com',
+                'to_address': 'user@example.com',
+                'subject': 'Subject',
+                'message_body': 'Body',
+                'received_date': datetime.utcnow(),
+                'is_read': False,
+                'labels': 'INBOX',
+                'snippet': 'Snippet'
+            }
+            for email_id in ('existing_1', 'new_1', 'new_2')
+        ]
+
+        result = fetcher.store_emails(emails)
+        assert result == 3
+
+        assert temp_db.query(Email).count() == 3
+        updated_email = temp_db.query(Email).filter_by(id='existing_1').first()
+        assert updated_email.from_address == 'new@example.com'
+
+    @pytest.mark.parametrize('upsert', [True, False])
+    @patch('email_fetcher.get_gmail_service')
+    def test_store_emails_different_keys(self, mock_get_service, temp_db, upsert):
+        """Test storing a batch whose email dictionaries have different keys"""
+        fetcher = EmailFetcher()
+        fetcher.session = temp_db
+        
+        temp_db.add(Email(
+            id='existing_1',
+            thread_id='thread_1',
+            from_address='old@example.com',
+            message_body='Stored body',
+            received_date=datetime.utcnow()
+        ))
+        temp_db.commit()
+        
+        base = {'thread_id': 'thread_1', 'from_address': 'new@example.com',
+                'received_date': datetime.utcnow()}
+        emails = [
+            {'id': 'new_1', **base},
+            {'id': 'new_2', **base, 'subject': 'Second', 'message_body': 'Body'},
+            {'id': 'existing_1', **base, 'subject': 'Updated'}
+        ]
+        
+        # Without an upsert construct the generic insert/update path is used
+        with patch.dict('email_fetcher.UPSERT_INSERTS', clear=not upsert):
+            assert fetcher.store_emails(emails) == 3
+        
+        stored = {email.id: email for email in temp_db.query(Email)}
+        assert stored['new_2'].subject == 'Second'
+        assert stored['new_2'].message_body == 'Body'
+        assert stored['existing_1'].subject == 'Updated'
+        assert stored['existing_1'].message_body == 'Stored body'
+    
+    @patch('email_fetcher.get_gmail_service')
+    def test_upsert_rows_postgresql(self, mock_get_service):
+        """Test the PostgreSQL upsert statement for stored emails"""
+        fetcher = EmailFetcher()
+        fetcher.session = Mock()
+        
+        rows = [{'id': 'test_email_1', 'thread_id': 'thread_1', 'subject': 'Subject'}]
+        fetcher._upsert_rows(rows, postgresql_insert)
+        
+        stmt, params = fetcher.session.execute.call_args[0]
+        sql = str(stmt.compile(dialect=postgresql.dialect()))
+        assert 'ON CONFLICT (id) DO UPDATE SET' in sql
+        assert 'thread_id = excluded.thread_id' in sql
+        assert 'updated_at' in sql
+        assert params == rows
+    
     def test_store_emails_error_handling(self, temp_db):
         """Test error handling during email storage"""
         fetcher = EmailFetcher()
@@ -271,12 +423,69 @@ class TestEmailFetcher:
         }
         mock_service.users().messages().get.return_value.execute.return_value = mock_message
         
+        # Mock batch HTTP requests by executing each queued request in turn
+        def new_batch_http_request(callback):
+            queued = []
+            batch = Mock()
+            batch.add.side_effect = lambda request, request_id: queued.append((request_id, request))
+            batch.execute.side_effect = lambda: [
+                callback(request_id, request.execute(), None) for request_id, request in queued
+            ]
+            return batch
+        mock_service.new_batch_http_request.side_effect = new_batch_http_request
+        
         fetcher = EmailFetcher()
         result = fetcher.fetch_emails(max_results=2)
         
         assert len(result) == 2
         assert result[0]['id'] == 'msg1'
     
+    @patch('email_fetcher.GMAIL_BATCH_LIMIT', 2)
+    @patch('email_fetcher.get_gmail_service')
+    def test_fetch_emails_batch_failures(self, mock_get_service, temp_db):
+        """Test that failed sub-requests and batches are fetched one at a time"""
+        mock_service = Mock()
+        mock_get_service.return_value = mock_service
+        
+        message_ids = ['msg1', 'msg2', 'msg3', 'msg4']
+        mock_service.users().messages().list.return_value.execute.return_value = {
+            'messages': [{'id': message_id} for message_id in message_ids]
+        }
+        
+        def message(message_id):
+            return {
+                'id': message_id,
+                'threadId': 'thread1',
+                'labelIds': ['INBOX'],
+                'payload': {'headers': [{'name': 'From', 'value': 'test@example.com'}]}
+            }
+        
+        # First batch: msg2 is rate limited; second batch: the request itself fails
+        def new_batch_http_request(callback):
+            queued = []
+            batch = Mock()
+            batch.add.side_effect = lambda request, request_id: queued.append(request_id)
+            
+            def execute():
+                if queued[0] == 'msg3':
+                    raise Exception("Connection reset")
+                for request_id in queued:
+                    if request_id == 'msg2':
+                        callback(request_id, None, Exception("rateLimitExceeded"))
+                    else:
+                        callback(request_id, message(request_id), None)
+            batch.execute.side_effect = execute
+            return batch
+        mock_service.new_batch_http_request.side_effect = new_batch_http_request
+        
+        fetcher = EmailFetcher()
+        with patch.object(fetcher, '_fetch_email_details',
+                          side_effect=lambda message_id, need_body: message(message_id)) as fetch_one:
+            result = fetcher.fetch_emails(max_results=4)
+        
+        assert [email_data['id'] for email_data in result] == message_ids
+        assert [call.args[0] for call in fetch_one.call_args_list] == ['msg2', 'msg3', 'msg4']
+    
     @patch('email_fetcher.get_gmail_service')
     def test_fetch_emails_error(self, mock_get_service, temp_db):
         """Test email fetching with error"""
@@ -3,31 +3,30 @@ Integration tests for the complete Gmail Rule Operations system
 """
 import pytest
 import json
-import tempfile
-import os
-from datetime import datetime, timedelta
-from unittest.mock import Mock, patch, MagicMock
+from datetime import timedelta
 
-from email_fetcher import EmailFetcher
 from rule_engine import RuleEngine
-from models import Email, RuleExecution, Base
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from models import Email, RuleExecution
+from sqlalchemy import func, insert, select
+
+# Column values shared by the emails the tests seed
+BASE_EMAIL = dict(
+    thread_id='thread_1',
+    to_address='user@example.com',
+    message_body='',
+    is_read=False,
+    labels='INBOX',
+    snippet=''
+)
+
+def make_email(**overrides):
+    """Build an email row from BASE_EMAIL"""
+    return {**BASE_EMAIL, **overrides}
 
 class TestIntegration:
     """Integration tests for the complete system"""
     
-    @pytest.fixture
-    def temp_db(self):
-        """Create temporary database for testing"""
-        engine = create_engine('sqlite:///:memory:')
-        Base.metadata.create_all(engine)
-        Session = sessionmaker(bind=engine)
-        session = Session()
-        yield session
-        session.close()
-    
-    @pytest.fixture
+    @pytest.fixture(scope="class")
     def sample_rules(self):
         """Sample rules for testing"""
         return {
@@ -80,225 +79,178 @@ class TestIntegration:
             ]
         }
     
-    def test_end_to_end_newsletter_processing(self, temp_db, sample_rules):
+    @pytest.fixture(scope="class")
+    def rules_file(self, tmp_path_factory, sample_rules):
+        """Write the sample rules once for every test in the class"""
+        path = tmp_path_factory.mktemp("rules") / "rules.json"
+        path.write_text(json.dumps(sample_rules))
+        return str(path)
+    
+    @pytest.fixture(autouse=True)
+    def patch_rules_file(self, monkeypatch, rules_file):
+        """Point the rule engine at the sample rules for every test"""
+        monkeypatch.setattr('rule_engine.config.RULES_FILE', rules_file)
+    
+    def test_end_to_end_newsletter_processing(self, temp_db, now):
         """Test complete end-to-end processing of newsletter emails"""
-        # Create temporary rules file
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False) as f:
-            json.dump(sample_rules, f)
-            temp_file = f.name
+        # Create sample emails
+        newsletter_email = make_email(
+            id='newsletter_1',
+            from_address='newsletter@company.com',
+            subject='Weekly Newsletter Update',
+            received_date=now
+        )
+        
+        regular_email = make_email(
+            id='regular_1',
+            from_address='friend@example.com',
+            subject='Hello there',
+            received_date=now
+        )
+        
+        # Add emails to database
+        temp_db.execute(insert(Email), [newsletter_email, regular_email])
+        temp_db.commit()
+        
+        # Process rules
+        engine = RuleEngine(session=temp_db)
         
-        try:
-            with patch('rule_engine.config.RULES_FILE', temp_file):
-                # Create sample emails
-                newsletter_email = Email(
-                    id='newsletter_1',
-                    thread_id='thread_1',
-                    from_address='newsletter@company.com',
-                    to_address='user@example.com',
-                    subject='Weekly Newsletter Update',
-                    message_body='Check out our latest news',
-                    received_date=datetime.utcnow(),
-                    is_read=False,
-                    labels='INBOX',
-                    snippet='Newsletter snippet'
-                )
-                
-                regular_email = Email(
-                    id='regular_1',
-                    thread_id='thread_2',
-                    from_address='friend@example.com',
-                    to_address='user@example.com',
-                    subject='Hello there',
-                    message_body='Just saying hi',
-                    received_date=datetime.utcnow(),
-                    is_read=False,
-                    labels='INBOX',
-                    snippet='Regular email snippet'
-                )
-                
-                # Add emails to database
-                temp_db.add(newsletter_email)
-                temp_db.add(regular_email)
-                temp_db.commit()
-                
-                # Process rules
-                engine = RuleEngine()
-                engine.session = temp_db
-                
-                stats = engine.process_emails()
-                
-                # Verify results
-                assert stats['emails_processed'] == 2
-                assert stats['rules_matched'] >= 1  # Newsletter rule should match
-                assert stats['actions_executed'] >= 1
-                
-                # Verify newsletter email was processed
-                updated_newsletter = temp_db.query(Email).filter_by(id='newsletter_1').first()
-                assert updated_newsletter.is_read is True
-                assert 'Newsletters' in updated_newsletter.labels
-                
-                # Verify regular email was not affected by newsletter rule
-                updated_regular = temp_db.query(Email).filter_by(id='regular_1').first()
-                assert updated_regular.is_read is False
-                assert 'Newsletters' not in updated_regular.labels
-                
-                # Verify rule execution was logged
-                executions = temp_db.query(RuleExecution).filter_by(email_id='newsletter_1').all()
-                assert len(executions) >= 1
-                
-                engine.close()
-                
-        finally:
-            os.unlink(temp_file)
+        stats = engine.process_emails()
+        
+        # Verify results
+        assert stats['emails_processed'] == 2
+        assert stats['rules_matched'] >= 1  # Newsletter rule should match
+        assert stats['actions_executed'] >= 1
+        
+        # Verify newsletter email was processed
+        updated_newsletter = temp_db.execute(
+            select(Email.is_read, Email.labels).where(Email.id == 'newsletter_1')
+        ).one()
+        assert updated_newsletter.is_read is True
+        assert 'Newsletters' in updated_newsletter.labels
+        
+        # Verify regular email was not affected by newsletter rule
+        updated_regular = temp_db.execute(
+            select(Email.is_read, Email.labels).where(Email.id == 'regular_1')
+        ).one()
+        assert updated_regular.is_read is False
+        assert 'Newsletters' not in updated_regular.labels
+        
+        # Verify rule execution was logged
+        executions = temp_db.scalar(
+            select(func.count()).select_from(RuleExecution).where(RuleExecution.email_id == 'newsletter_1')
+        )
+        assert executions >= 1
+        
+        engine.close()
     
-    def test_end_to_end_old_email_processing(self, temp_db, sample_rules):
+    def test_end_to_end_old_email_processing(self, temp_db, now):
         """Test complete end-to-end processing of old emails"""
-        # Create temporary rules file
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False) as f:
-            json.dump(sample_rules, f)
-            temp_file = f.name
+        # Create old email
+        old_email = make_email(
+            id='old_email_1',
+            from_address='old@example.com',
+            subject='Old Message',
+            received_date=now - timedelta(days=35)
+        )
+        
+        # Add email to database
+        temp_db.execute(insert(Email), [old_email])
+        temp_db.commit()
+        
+        # Process rules
+        engine = RuleEngine(session=temp_db)
         
-        try:
-            with patch('rule_engine.config.RULES_FILE', temp_file):
-                # Create old email
-                old_email = Email(
-                    id='old_email_1',
-                    thread_id='thread_1',
-                    from_address='old@example.com',
-                    to_address='user@example.com',
-                    subject='Old Message',
-                    message_body='This is an old message',
-                    received_date=datetime.utcnow() - timedelta(days=35),
-                    is_read=False,
-                    labels='INBOX',
-                    snippet='Old email snippet'
-                )
-                
-                # Add email to database
-                temp_db.add(old_email)
-                temp_db.commit()
-                
-                # Process rules
-                engine = RuleEngine()
-                engine.session = temp_db
-                
-                stats = engine.process_emails()
-                
-                # Verify results
-                assert stats['emails_processed'] == 1
-                assert stats['rules_matched'] >= 1  # Old email rule should match
-                assert stats['actions_executed'] >= 1
-                
-                # Verify old email was marked as read
-                updated_old_email = temp_db.query(Email).filter_by(id='old_email_1').first()
-                assert updated_old_email.is_read is True
-                
-                engine.close()
-                
-        finally:
-            os.unlink(temp_file)
+        stats = engine.process_emails()
+        
+        # Verify results
+        assert stats['emails_processed'] == 1
+        assert stats['rules_matched'] >= 1  # Old email rule should match
+        assert stats['actions_executed'] >= 1
+        
+        # Verify old email was marked as read
+        updated_old_email = temp_db.execute(
+            select(Email.is_read, Email.labels).where(Email.id == 'old_email_1')
+        ).one()
+        assert updated_old_email.is_read is True
+        
+        engine.close()
     
-    def test_multiple_rules_same_email(self, temp_db, sample_rules):
+    def test_multiple_rules_same_email(self, temp_db, now):
         """Test that multiple rules can match the same email"""
-        # Create temporary rules file
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False) as f:
-            json.dump(sample_rules, f)
-            temp_file = f.name
+        # Create email that matches both rules (old newsletter)
+        old_newsletter = make_email(
+            id='old_newsletter_1',
+            from_address='newsletter@company.com',
+            subject='Old Newsletter',
+            received_date=now - timedelta(days=35)
+        )
+        
+        # Add email to database
+        temp_db.execute(insert(Email), [old_newsletter])
+        temp_db.commit()
+        
+        # Process rules
+        engine = RuleEngine(session=temp_db)
+        
+        stats = engine.process_emails()
+        
+        # Verify results - should match both rules
+        assert stats['emails_processed'] == 1
+        assert stats['rules_matched'] == 2  # Both rules should match
+        assert stats['actions_executed'] >= 2  # Actions from both rules
+        
+        # Verify email was processed by both rules
+        updated_email = temp_db.execute(
+            select(Email.is_read, Email.labels).where(Email.id == 'old_newsletter_1')
+        ).one()
+        assert updated_email.is_read is True  # From old email rule
+        assert 'Newsletters' in updated_email.labels  # From newsletter rule
         
-        try:
-            with patch('rule_engine.config.RULES_FILE', temp_file):
-                # Create email that matches both rules (old newsletter)
-                old_newsletter = Email(
-                    id='old_newsletter_1',
-                    thread_id='thread_1',
-                    from_address='newsletter@company.com',
-                    to_address='user@example.com',
-                    subject='Old Newsletter',
-                    message_body='Old newsletter content',
-                    received_date=datetime.utcnow() - timedelta(days=35),
-                    is_read=False,
-                    labels='INBOX',
-                    snippet='Old newsletter snippet'
-                )
-                
-                # Add email to database
-                temp_db.add(old_newsletter)
-                temp_db.commit()
-                
-                # Process rules
-                engine = RuleEngine()
-                engine.session = temp_db
-                
-                stats = engine.process_emails()
-                
-                # Verify results - should match both rules
-                assert stats['emails_processed'] == 1
-                assert stats['rules_matched'] == 2  # Both rules should match
-                assert stats['actions_executed'] >= 2  # Actions from both rules
-                
-                # Verify email was processed by both rules
-                updated_email = temp_db.query(Email).filter_by(id='old_newsletter_1').first()
-                assert updated_email.is_read is True  # From old email rule
-                assert 'Newsletters' in updated_email.labels  # From newsletter rule
-                
-                # Verify both rule executions were logged
-                executions = temp_db.query(RuleExecution).filter_by(email_id='old_newsletter_1').all()
-                assert len(executions) == 2
-                
-                engine.close()
-                
-        finally:
-            os.unlink(temp_file)
+        # Verify both rule executions were logged
+        executions = temp_db.scalar(
+            select(func.count()).select_from(RuleExecution).where(RuleExecution.email_id == 'old_newsletter_1')
+        )
+        assert executions == 2
+        
+        engine.close()
     
-    def test_no_matching_rules(self, temp_db, sample_rules):
+    def test_no_matching_rules(self, temp_db, now):
         """Test processing when no rules match"""
-        # Create temporary rules file
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False) as f:
-            json.dump(sample_rules, f)
-            temp_file = f.name
+        # Create email that doesn't match any rules
+        regular_email = make_email(
+            id='regular_1',
+            from_address='friend@example.com',
+            subject='Hello',
+            received_date=now - timedelta(days=5)  # Not old enough
+        )
+        
+        # Add email to database
+        temp_db.execute(insert(Email), [regular_email])
+        temp_db.commit()
+        
+        # Process rules
+        engine = RuleEngine(session=temp_db)
+        
+        stats = engine.process_emails()
+        
+        # Verify results - no rules should match
+        assert stats['emails_processed'] == 1
+        assert stats['rules_matched'] == 0
+        assert stats['actions_executed'] == 0
+        
+        # Verify email was not modified
+        unchanged_email = temp_db.execute(
+            select(Email.is_read, Email.labels).where(Email.id == 'regular_1')
+        ).one()
+        assert unchanged_email.is_read is False
+        assert unchanged_email.labels == 'INBOX'
+        
+        # Verify no rule executions were logged
+        executions = temp_db.scalar(
+            select(func.count()).select_from(RuleExecution).where(RuleExecution.email_id == 'regular_1')
+        )
+        assert executions == 0
         
-        try:
-            with patch('rule_engine.config.RULES_FILE', temp_file):
-                # Create email that doesn't match any rules
-                regular_email = Email(
-                    id='regular_1',
-                    thread_id='thread_1',
-                    from_address='friend@example.com',
-                    to_address='user@example.com',
-                    subject='Hello',
-                    message_body='Just a regular message',
-                    received_date=datetime.utcnow() - timedelta(days=5),  # Not old enough
-                    is_read=False,
-                    labels='INBOX',
-                    snippet='Regular email snippet'
-                )
-                
-                # Add email to database
-                temp_db.add(regular_email)
-                temp_db.commit()
-                
-                # Process rules
-                engine = RuleEngine()
-                engine.session = temp_db
-                
-                stats = engine.process_emails()
-                
-                # Verify results - no rules should match
-                assert stats['emails_processed'] == 1
-                assert stats['rules_matched'] == 0
-                assert stats['actions_executed'] == 0
-                
-                # Verify email was not modified
-                unchanged_email = temp_db.query(Email).filter_by(id='regular_1').first()
-                assert unchanged_email.is_read is False
-                assert unchanged_email.labels == 'INBOX'
-                
-                # Verify no rule executions were logged
-                executions = temp_db.query(RuleExecution).filter_by(email_id='regular_1').all()
-                assert len(executions) == 0
-                
-                engine.close()
-                
-        finally:
-            os.unlink(temp_file)
+        engine.close()
     
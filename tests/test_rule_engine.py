@@ -3,29 +3,18 @@ Test cases for the rule engine
 """
 import pytest
 import json
-import tempfile
 import os
 from datetime import datetime, timedelta
 from unittest.mock import Mock, patch
 
-from rule_engine import RuleEngine
-from models import Email, Base
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from rule_engine import (RuleEngine, _json_dumps, compile_matcher, compile_rule,
+                         compile_ruleset, parse_relative_date, rule_to_sql, rules_need_message_body)
+from models import Email, RuleExecution
+from sqlalchemy import event, false, func, insert, or_, select, text
 
 class TestRuleEngine:
     """Test cases for RuleEngine class"""
     
-    @pytest.fixture
-    def temp_db(self):
-        """Create temporary database for testing"""
-        engine = create_engine('sqlite:///:memory:')
-        Base.metadata.create_all(engine)
-        Session = sessionmaker(bind=engine)
-        session = Session()
-        yield session
-        session.close()
-    
     @pytest.fixture
     def sample_email(self):
         """Create sample email for testing"""
@@ -98,17 +87,26 @@ class TestRuleEngine:
             ]
         }
         
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False) as f:
-            json.dump(rules_data, f)
-            temp_file = f.name
-        
-        try:
-            with patch('rule_engine.config.RULES_FILE', temp_file):
-                engine = RuleEngine()
-                assert len(engine.rules) == 1
-                assert engine.rules[0]['name'] == 'Test Rule'
-        finally:
-            os.unlink(temp_file)
+        with patch('rule_engine.config.RULES_FILE', 'in-memory-rules.json'), \
+             patch('rule_engine._read_rules_file', return_value=json.dumps(rules_data).encode()):
+            engine = RuleEngine()
+            assert len(engine.rules) == 1
+            assert engine.rules[0]['name'] == 'Test Rule'
+    
+    def test_load_rules_cached_per_file_version(self, temp_db, tmp_path):
+        """Test that compiled rules are reused until the rules file changes"""
+        rules_file = tmp_path / 'rules.json'
+        rules_file.write_text(json.dumps({"rules": [{"name": "First", "conditions": []}]}))
+        
+        with patch('rule_engine.config.RULES_FILE', str(rules_file)):
+            first, second = RuleEngine(), RuleEngine()
+            assert first.rules[0] is second.rules[0]
+            assert first.rules is not second.rules
+            
+            rules_file.write_text(json.dumps({"rules": [{"name": "Second", "conditions": []}]}))
+            stat = rules_file.stat()
+            os.utime(rules_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+            assert RuleEngine().rules[0]['name'] == 'Second'
     
     def test_load_rules_file_not_found(self, temp_db):
         """Test rule loading when file doesn't exist"""
@@ -118,16 +116,10 @@ class TestRuleEngine:
     
     def test_load_rules_invalid_json(self, temp_db):
         """Test rule loading with invalid JSON"""
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False) as f:
-            f.write('invalid json content')
-            temp_file = f.name
-        
-        try:
-            with patch('rule_engine.config.RULES_FILE', temp_file):
-                engine = RuleEngine()
-                assert engine.rules == []
-        finally:
-            os.unlink(temp_file)
+        with patch('rule_engine.config.RULES_FILE', 'in-memory-rules.json'), \
+             patch('rule_engine._read_rules_file', return_value=b'invalid json content'):
+            engine = RuleEngine()
+            assert engine.rules == []
     
     def test_evaluate_condition_contains(self, temp_db, sample_email):
         """Test condition evaluation with 'contains' predicate"""
@@ -260,8 +252,7 @@ class TestRuleEngine:
     
     def test_mark_as_read(self, temp_db, sample_email):
         """Test marking email as read"""
-        engine = RuleEngine()
-        engine.session = temp_db
+        engine = RuleEngine(session=temp_db)
         
         temp_db.add(sample_email)
         temp_db.commit()
@@ -269,11 +260,13 @@ class TestRuleEngine:
         result = engine._mark_as_read(sample_email)
         assert result is True
         assert sample_email.is_read is True
+        
+        temp_db.commit()
+        assert temp_db.scalar(select(Email.is_read).where(Email.id == sample_email.id)) is True
     
     def test_mark_as_unread(self, temp_db, sample_email):
         """Test marking email as unread"""
-        engine = RuleEngine()
-        engine.session = temp_db
+        engine = RuleEngine(session=temp_db)
         
         sample_email.is_read = True
         temp_db.add(sample_email)
@@ -282,11 +275,13 @@ class TestRuleEngine:
         result = engine._mark_as_unread(sample_email)
         assert result is True
         assert sample_email.is_read is False
+        
+        temp_db.commit()
+        assert temp_db.scalar(select(Email.is_read).where(Email.id == sample_email.id)) is False
     
     def test_move_message(self, temp_db, sample_email):
         """Test moving email to different label"""
-        engine = RuleEngine()
-        engine.session = temp_db
+        engine = RuleEngine(session=temp_db)
         
         temp_db.add(sample_email)
         temp_db.commit()
@@ -294,11 +289,29 @@ class TestRuleEngine:
         result = engine._move_message(sample_email, "Archive")
         assert result is True
         assert "Archive" in sample_email.labels
+        
+        temp_db.commit()
+        assert temp_db.scalar(select(Email.labels).where(Email.id == sample_email.id)) == 'INBOX,Archive'
+    
+    def test_move_message_without_label(self, temp_db, sample_email):
+        """Test that a move action without a label changes nothing"""
+        engine = RuleEngine(session=temp_db)
+        
+        temp_db.add(sample_email)
+        temp_db.commit()
+        labels = sample_email.labels
+        
+        rule = {"name": "No Label", "actions": [{"type": "move message"}]}
+        assert engine.execute_actions(rule, sample_email) == []
+        assert engine._move_message(sample_email, None) is False
+        assert engine._move_message(sample_email, "") is False
+        assert engine._move_message(sample_email, ["Archive"]) is False
+        assert sample_email.labels == labels
+        assert engine.pending_updates == {}
     
     def test_execute_actions(self, temp_db, sample_email):
         """Test executing actions on email"""
-        engine = RuleEngine()
-        engine.session = temp_db
+        engine = RuleEngine(session=temp_db)
         
         temp_db.add(sample_email)
         temp_db.commit()
@@ -321,6 +334,12 @@ class TestRuleEngine:
         assert len(actions) == 2
         assert sample_email.is_read is True
         assert "Test Folder" in sample_email.labels
+        
+        temp_db.commit()
+        stored = temp_db.execute(
+            select(Email.is_read, Email.labels).where(Email.id == sample_email.id)
+        ).one()
+        assert tuple(stored) == (True, 'INBOX,Test Folder')
     
     def test_get_field_value(self, temp_db, sample_email):
         """Test getting field values from email"""
@@ -339,4 +358,381 @@ class TestRuleEngine:
         result = engine._compare_dates(datetime.utcnow(), "invalid format", "less")
         assert result is False
     
-
+    def test_parse_relative_date(self):
+        """Test parsing relative date condition values"""
+        assert parse_relative_date("7 days") == timedelta(days=7)
+        assert parse_relative_date(" 1 Month ") == timedelta(days=30)
+        assert parse_relative_date("invalid format") is None
+        assert parse_relative_date("7 weeks") is None
+        assert parse_relative_date("days") is None
+        assert parse_relative_date(None) is None
+    
+    def test_json_dumps_compact_unicode(self):
+        """Test that stored action lists are compact and keep non-ASCII text"""
+        assert _json_dumps(["Moved to Café: id1", "Marked as read: id1"]) == \
+            '["Moved to Café: id1","Marked as read: id1"]'
+    
+    def test_rules_need_message_body(self):
+        """Test detecting rules that inspect the message body"""
+        subject_rule = {"conditions": [{"field": "Subject", "predicate": "contains", "value": "a"}]}
+        message_rule = {"conditions": [{"field": "Message", "predicate": "contains", "value": "a"}]}
+        
+        assert rules_need_message_body([subject_rule]) is False
+        assert rules_need_message_body([subject_rule, message_rule]) is True
+        assert rules_need_message_body([]) is False
+    
+    def test_compile_rule(self, newsletter_email, old_email):
+        """Test compiling a rule into a matcher"""
+        rule = {
+            "name": "Old Newsletter",
+            "predicate": "All",
+            "conditions": [
+                {"field": "From", "predicate": "contains", "value": "NEWSLETTER"},
+                {"field": "Received Date/Time", "predicate": "less than", "value": "30 days"}
+            ],
+            "actions": []
+        }
+        
+        compiled = compile_rule(rule)
+        assert compiled['name'] == 'Old Newsletter'
+        assert 'matcher' not in rule  # Original rule is left untouched
+        
+        assert compiled['matcher'](newsletter_email) is False  # Too recent
+        newsletter_email.received_date = old_email.received_date
+        assert compiled['matcher'](newsletter_email) is True
+        assert compiled['matcher'](old_email) is False  # Not a newsletter
+    
+    def test_compile_rule_checks_cheap_conditions_first(self, sample_email):
+        """Test that a decided rule never reads the message body"""
+        rule = {
+            "predicate": "All",
+            "conditions": [
+                {"field": "Message", "predicate": "contains", "value": "test"},
+                {"field": "Received Date/Time", "predicate": "greater than", "value": "1 days"}
+            ]
+        }
+        sample_email.received_date = datetime.utcnow() - timedelta(days=5)
+        
+        with patch.object(Email, 'message_body', property(lambda email: pytest.fail('body read'))):
+            assert compile_rule(rule)['matcher'](sample_email) is False
+            assert compile_ruleset([rule])(sample_email) == []
+            assert compile_ruleset([rule], datetime.utcnow())(sample_email) == []
+    
+    def test_compile_ruleset_matches_evaluate_rule(self, sample_email, old_email, newsletter_email):
+        """Test that the generated rule set function agrees with evaluate_rule"""
+        rules = [
+            {"predicate": "All", "conditions": [
+                {"field": "From", "predicate": "contains", "value": "Newsletter"},
+                {"field": "Subject", "predicate": "contains", "value": "newsletter"}
+            ]},
+            {"predicate": "Any", "conditions": [
+                {"field": "Received Date/Time", "predicate": "less than", "value": "30 days"},
+                {"field": "Subject", "predicate": "equals", "value": "test subject"}
+            ]},
+            {"predicate": "All", "conditions": [
+                {"field": "Message", "predicate": "does not contain", "value": "it's \"quoted\""},
+                {"field": "To", "predicate": "does not equal", "value": "other@example.com"}
+            ]},
+            {"predicate": "Any", "conditions": [
+                {"field": "Unknown", "predicate": "does not contain", "value": "x"}
+            ]},
+            {"predicate": "Any", "conditions": [
+                {"field": "Received Date/Time", "predicate": "greater than", "value": "invalid"}
+            ]},
+            {"predicate": "All", "conditions": []}
+        ]
+        
+        engine = RuleEngine()
+        match_ruleset = compile_ruleset(rules)
+        
+        for email in (sample_email, old_email, newsletter_email):
+            expected = [index for index, rule in enumerate(rules) if engine.evaluate_rule(rule, email)]
+            assert match_ruleset(email) == expected
+    
+    def test_contains_metacharacters_match_literally(self, temp_db, sample_email):
+        """Test that regex and LIKE metacharacters in literals are matched as text"""
+        sample_email.subject = 'Sale: 100% off a.b [today]'
+        temp_db.add(sample_email)
+        temp_db.commit()
+        
+        for value, expected in [('100%', True), ('a.b', True), ('[today]', True),
+                                ('.*', False), ('100_', False), ('a_b', False)]:
+            rule = {"predicate": "All", "conditions": [
+                {"field": "Subject", "predicate": "contains", "value": value}
+            ]}
+            sql_matches = temp_db.scalar(select(func.count()).select_from(Email).where(rule_to_sql(rule)[0]))
+            
+            assert compile_rule(rule)['matcher'](sample_email) is expected
+            assert compile_ruleset([rule])(sample_email) == ([0] if expected else [])
+            assert sql_matches == int(expected)
+    
+    def test_compile_ruleset_reference_time(self, old_email):
+        """Test that date conditions compare against a supplied clock reading"""
+        rules = [{"predicate": "All", "conditions": [
+            {"field": "Received Date/Time", "predicate": "less than", "value": "30 days"}
+        ]}]
+        
+        assert compile_ruleset(rules)(old_email) == [0]
+        assert compile_ruleset(rules, old_email.received_date)(old_email) == []
+        assert compile_matcher(rules[0])(old_email) is True
+        assert compile_matcher(rules[0], old_email.received_date)(old_email) is False
+        assert rule_to_sql({"conditions": [
+            {"field": "Received Date/Time", "predicate": "less than", "value": "1 day"}
+        ]}, datetime(2024, 1, 2))[0].right.value == datetime(2024, 1, 1)
+    
+    def test_rule_to_sql_prefilter(self, temp_db, sample_email, old_email, newsletter_email):
+        """Test that the rule clauses OR-ed together keep exactly the emails a rule can match"""
+        temp_db.add_all([sample_email, old_email, newsletter_email])
+        temp_db.commit()
+        
+        def prefiltered_ids(rules):
+            # The same WHERE clause process_emails builds
+            query = select(Email.id).where(or_(false(), *(rule_to_sql(rule)[0] for rule in rules)))
+            return set(temp_db.scalars(query))
+        
+        newsletter_rule = {"predicate": "All", "conditions": [
+            {"field": "From", "predicate": "contains", "value": "NEWSLETTER"}
+        ]}
+        old_rule = {"predicate": "Any", "conditions": [
+            {"field": "Received Date/Time", "predicate": "less than", "value": "30 days"}
+        ]}
+        negated_rule = {"predicate": "All", "conditions": [
+            {"field": "Subject", "predicate": "does not equal", "value": "test subject"},
+            {"field": "Message", "predicate": "does not contain", "value": "100%"}
+        ]}
+        
+        assert prefiltered_ids([newsletter_rule]) == {'newsletter_1'}
+        assert prefiltered_ids([newsletter_rule, old_rule]) == {'newsletter_1', 'old_email_1'}
+        assert prefiltered_ids([negated_rule]) == {'newsletter_1', 'old_email_1'}
+        assert prefiltered_ids([]) == set()
+        
+        # Conditions SQL cannot mirror exactly fall back to loading every email
+        unicode_rule = {"predicate": "All", "conditions": [
+            {"field": "Subject", "predicate": "contains", "value": "café"}
+        ]}
+        assert len(prefiltered_ids([unicode_rule])) == 3
+    
+    def test_sql_conditions_fold_case_like_python(self, temp_db, now):
+        """Test that exact SQL text conditions agree with str.lower() on non-ASCII fields"""
+        subjects = ['\u212a-pop', 'K-POP', '\u0130nbox', 'Stra\u00dfe', None]
+        temp_db.execute(insert(Email), [
+            {'id': f'email_{index}', 'thread_id': 'thread', 'from_address': 'a@example.com',
+             'subject': subject, 'received_date': now}
+            for index, subject in enumerate(subjects)
+        ])
+        emails = temp_db.scalars(select(Email).order_by(Email.id)).all()
+        
+        for predicate in ['contains', 'does not contain', 'equals', 'does not equal']:
+            for value in ['k-pop', 'K-Pop', 'i', 'inbox', 'strasse', 'e']:
+                rule = {"conditions": [{"field": "Subject", "predicate": predicate, "value": value}]}
+                clause, exact = rule_to_sql(rule)
+                assert exact is True
+                
+                sql_ids = set(temp_db.scalars(select(Email.id).where(clause)))
+                python_ids = {email.id for email in emails if compile_matcher(rule)(email)}
+                assert sql_ids == python_ids, (predicate, value)
+    
+    def test_equals_condition_uses_expression_index(self, temp_db):
+        """Test that SQL equals conditions can be served by the lower() indexes"""
+        for field, index_name in [('From', 'ix_email_from_lower'),
+                                  ('To', 'ix_email_to_lower'),
+                                  ('Subject', 'ix_email_subject_lower')]:
+            clause, exact = rule_to_sql({"conditions": [
+                {"field": field, "predicate": "equals", "value": "Boss@Example.com"}
+            ]})
+            assert exact is True
+            
+            query = select(Email.id).where(clause)
+            compiled = query.compile(temp_db.get_bind(), compile_kwargs={"literal_binds": True})
+            plan = temp_db.execute(text(f"EXPLAIN QUERY PLAN {compiled}")).all()
+            assert any(index_name in row[-1] for row in plan)
+    
+    def test_process_emails_commits_in_batches(self, temp_db, sample_email, old_email, newsletter_email):
+        """Test that processing commits once per batch rather than per action"""
+        temp_db.add_all([sample_email, old_email, newsletter_email])
+        temp_db.commit()
+        
+        engine = RuleEngine(session=temp_db)
+        engine.rules = [{
+            "name": "Everything",
+            "predicate": "Any",
+            "conditions": [{"field": "To", "predicate": "contains", "value": "user"}],
+            "actions": [
+                {"type": "mark as read", "value": ""},
+                {"type": "move message", "value": "Seen"}
+            ]
+        }]
+        
+        with patch('rule_engine.COMMIT_INTERVAL', 2), \
+             patch.object(temp_db, 'commit', wraps=temp_db.commit) as commit:
+            stats = engine.process_emails()
+        
+        assert stats['actions_executed'] == 6
+        assert commit.call_count == 2  # After the second email and at the end
+        assert temp_db.query(RuleExecution).count() == 3
+    
+    def test_process_emails_resets_reference_time(self, temp_db, old_email):
+        """Test that direct date comparisons after a run read the clock again"""
+        temp_db.add(old_email)
+        temp_db.commit()
+        
+        engine = RuleEngine(session=temp_db)
+        engine.rules = []
+        engine.process_emails()
+        
+        assert engine._now is None
+        recent = datetime.utcnow() - timedelta(hours=1)
+        assert engine._compare_dates(recent, "1 days", "greater") is True
+    
+    def test_process_emails_sql_and_python_rules(self, temp_db, sample_email, newsletter_email):
+        """Test that rules SQL cannot express exactly are still evaluated in Python"""
+        sample_email.subject = 'CAFÉ meeting'
+        temp_db.add_all([sample_email, newsletter_email])
+        temp_db.commit()
+        
+        sql_rule = {
+            "name": "Newsletter",
+            "predicate": "All",
+            "conditions": [{"field": "From", "predicate": "contains", "value": "newsletter"}],
+            "actions": [{"type": "move message", "value": "Newsletters"}]
+        }
+        python_rule = {
+            "name": "Cafe",
+            "predicate": "All",
+            "conditions": [{"field": "Subject", "predicate": "contains", "value": "café"}],
+            "actions": [{"type": "move message", "value": "Cafe"}]
+        }
+        assert rule_to_sql(sql_rule)[1] is True
+        assert rule_to_sql(python_rule)[1] is False
+        
+        engine = RuleEngine(session=temp_db)
+        engine.rules = [sql_rule, python_rule]
+        
+        stats = engine.process_emails()
+        
+        assert stats['emails_processed'] == 2
+        assert stats['rules_matched'] == 2
+        assert sample_email.labels == 'INBOX,Cafe'
+        assert newsletter_email.labels == 'INBOX,Newsletters'
+    
+    def test_process_emails_bulk_updates(self, temp_db, sample_email, old_email, newsletter_email):
+        """Test that action results reach the database as grouped bulk UPDATEs"""
+        temp_db.add_all([sample_email, old_email, newsletter_email])
+        temp_db.commit()
+        
+        engine = RuleEngine(session=temp_db)
+        engine.rules = [{
+            "name": "Everything",
+            "predicate": "Any",
+            "conditions": [{"field": "To", "predicate": "contains", "value": "user"}],
+            "actions": [
+                {"type": "mark as read", "value": ""},
+                {"type": "move message", "value": "Seen"}
+            ]
+        }]
+        
+        with patch.object(temp_db, 'execute', wraps=temp_db.execute) as execute:
+            engine.process_emails()
+        
+        updates = [call for call in execute.call_args_list if str(call.args[0]).startswith('UPDATE')]
+        assert len(updates) == 1  # Every email ends up with the same values
+        assert engine.pending_updates == {}
+        
+        temp_db.expire_all()
+        for email in temp_db.query(Email).all():
+            assert email.is_read is True
+            assert email.labels == 'INBOX,Seen'
+    
+    def test_process_emails_defers_unused_columns(self, temp_db, sample_email):
+        """Test that message bodies are only loaded when a Python rule reads them"""
+        temp_db.add(sample_email)
+        temp_db.commit()
+        
+        engine = RuleEngine(session=temp_db)
+        subject_rule = {
+            "name": "Subject",
+            "predicate": "All",
+            "conditions": [{"field": "Subject", "predicate": "contains", "value": "test"}],
+            "actions": [{"type": "mark as read", "value": ""}]
+        }
+        body_rule = {
+            "name": "Body",
+            "predicate": "All",
+            "conditions": [{"field": "Message", "predicate": "contains", "value": "tést"}],
+            "actions": []
+        }
+        
+        def email_query(rules):
+            engine.rules = rules
+            with patch.object(temp_db, 'execute', wraps=temp_db.execute) as execute:
+                engine.process_emails()
+            return str(execute.call_args_list[0].args[0])
+        
+        query = email_query([subject_rule])
+        assert 'emails.labels' in query
+        assert 'message_body' not in query
+        assert 'snippet' not in query
+        
+        query = email_query([body_rule])
+        assert 'emails.message_body' in query
+        assert 'snippet' not in query
+    
+    def test_process_emails_single_query(self, temp_db, sample_email, old_email, newsletter_email):
+        """Test that rules translated to SQL are matched in one SELECT"""
+        temp_db.add_all([sample_email, old_email, newsletter_email])
+        temp_db.commit()
+        
+        engine = RuleEngine(session=temp_db)
+        engine.rules = [
+            {
+                "name": "Newsletter",
+                "predicate": "All",
+                "conditions": [{"field": "From", "predicate": "contains", "value": "newsletter"}],
+                "actions": [{"type": "mark as read", "value": ""}]
+            },
+            {
+                "name": "Old",
+                "predicate": "Any",
+                "conditions": [{"field": "Received Date/Time", "predicate": "less than", "value": "30 days"}],
+                "actions": [{"type": "mark as read", "value": ""}]
+            }
+        ]
+        
+        with patch.object(temp_db, 'execute', wraps=temp_db.execute) as execute:
+            stats = engine.process_emails()
+        
+        selects = [call for call in execute.call_args_list if str(call.args[0]).startswith('SELECT')]
+        assert len(selects) == 1
+        assert engine.python_rules == []
+        assert stats['rules_matched'] == 2
+    
+    def test_process_emails_one_update_for_many_rows(self, temp_db, db_engine, now):
+        """Test that marking 100 emails as read reaches the database as one UPDATE"""
+        temp_db.execute(insert(Email), [
+            {'id': f'bulk_{index}', 'thread_id': 'thread', 'from_address': 'news@example.com',
+             'received_date': now, 'is_read': False, 'labels': 'INBOX'}
+            for index in range(100)
+        ])
+        temp_db.commit()
+        
+        engine = RuleEngine(session=temp_db)
+        engine.rules = [{
+            "name": "Read news",
+            "predicate": "All",
+            "conditions": [{"field": "From", "predicate": "contains", "value": "news"}],
+            "actions": [{"type": "mark as read", "value": ""}]
+        }]
+        
+        statements = []
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        
+        event.listen(db_engine, 'before_cursor_execute', record)
+        try:
+            stats = engine.process_emails()
+        finally:
+            event.remove(db_engine, 'before_cursor_execute', record)
+        
+        assert stats['actions_executed'] == 100
+        assert len([statement for statement in statements if statement.startswith('UPDATE')]) == 1
+        assert temp_db.scalar(select(func.count()).select_from(Email).where(Email.is_read)) == 100